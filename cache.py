@@ -0,0 +1,92 @@
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+from functools import lru_cache
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, Optional, Tuple
+from database import supabase_client
+
+@lru_cache(maxsize=32)
+def _instructions_digest(instructions: str) -> str:
+    # Instructions are module-level constants, so each one is normalized and hashed once
+    return hashlib.sha256(" ".join(instructions.split()).encode("utf-8")).hexdigest()
+
+class LLMCache:
+    """
+    Content-addressed cache for parsed LLM responses.
+    
+    Lookups hit an in-process LRU first and fall back to the Supabase
+    llm_cache table, which is shared across workers and restarts.
+    """
+    
+    def __init__(self, ttl_seconds: int = 86400, local_maxsize: int = 1024, local_ttl_seconds: int = 3600):
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self.local_maxsize = local_maxsize
+        self.local_ttl = local_ttl_seconds
+        self._local: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+    
+    @staticmethod
+    def make_key(model: str, prompt: str, instructions: str = "") -> str:
+        """Hash the model, instructions and whitespace-normalized prompt so prompt or model changes never hit stale entries"""
+        normalized = " ".join(prompt.split())
+        return hashlib.sha256(f"{model}|{_instructions_digest(instructions)}|{normalized}".encode("utf-8")).hexdigest()
+    
+    def _get_local(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._local.get(key)
+        if entry is None:
+            return None
+        
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._local[key]
+            return None
+        
+        self._local.move_to_end(key)
+        return value
+    
+    def _set_local(self, key: str, value: Dict[str, Any]) -> None:
+        self._local[key] = (time.monotonic() + self.local_ttl, value)
+        self._local.move_to_end(key)
+        while len(self._local) > self.local_maxsize:
+            self._local.popitem(last=False)
+    
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Return the cached response for a key, or None on miss or expiry"""
+        value = self._get_local(key)
+        if value is not None:
+            return value
+        
+        try:
+            cutoff = (datetime.now(timezone.utc) - self.ttl).isoformat()
+            supabase = supabase_client.get_client()
+            response = await asyncio.to_thread(
+                supabase.table("llm_cache").select("response").eq("hash", key).gte("created_at", cutoff).limit(1).execute
+            )
+            
+            if response.data:
+                value = response.data[0]["response"]
+                self._set_local(key, value)
+                return value
+        except Exception as e:
+            print(f"LLM cache lookup failed: {e}")
+        
+        return None
+    
+    async def set(self, key: str, model: str, response: Dict[str, Any]) -> None:
+        """Store a parsed response; cache failures never break the request"""
+        self._set_local(key, response)
+        
+        try:
+            supabase = supabase_client.get_client()
+            await asyncio.to_thread(supabase.table("llm_cache").upsert({
+                "hash": key,
+                "model": model,
+                "response": response,
+                "created_at": datetime.now(timezone.utc).isoformat()  # Refresh the TTL on upsert
+            }).execute)
+        except Exception as e:
+            print(f"LLM cache write failed: {e}")
+
+# Global instance
+llm_cache = LLMCache()
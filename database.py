@@ -1,11 +1,17 @@
 import os
+from typing import Optional
 from supabase import create_client, Client
 from dotenv import load_dotenv
 
-load_dotenv()
-
 class SupabaseClient:
+    """Creates the Supabase client on first use, so importing this module does no setup work"""
+    
     def __init__(self):
+        self.client: Optional[Client] = None
+        self.mock = False
+    
+    def _connect(self):
+        load_dotenv()
         self.url = os.getenv("SUPABASE_URL")
         self.key = os.getenv("SUPABASE_KEY")
         
@@ -14,11 +20,13 @@ class SupabaseClient:
         
         # Check if we're using mock credentials for development
         if self.url.startswith("https://mock-") or self.key.startswith("mock_"):
-            self.client = None  # Mock client for development
+            self.mock = True  # Mock client for development
         else:
-            self.client: Client = create_client(self.url, self.key)
+            self.client = create_client(self.url, self.key)
     
     def get_client(self) -> Client:
+        if self.client is None and not self.mock:
+            self._connect()
         if self.client is None:
             raise ValueError("Mock Supabase client - API calls not available in development mode")
         return self.client
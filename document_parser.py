@@ -2,17 +2,116 @@ import os
 import io
 import base64
 import asyncio
-from typing import Dict, Any, Optional, Tuple
+import time
+import math
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
 from io import BytesIO
 import fitz  # PyMuPDF
 import pytesseract
 from PIL import Image
-from pdf2image import convert_from_bytes
 import httpx
-from tenacity import retry, stop_after_attempt, wait_exponential
+import orjson
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+from functools import lru_cache
 from dotenv import load_dotenv
 
-load_dotenv()
+def _is_transient(exc: BaseException) -> bool:
+    """Retry timeouts, dropped connections, 429 and 5xx responses; other 4xx errors are final"""
+    if isinstance(exc, httpx.TransportError):
+        return True
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code == 429 or exc.response.status_code >= 500
+    return False
+
+def _ocr_page(pdf_path: str, page_index: int) -> str:
+    """Render and OCR a single PDF page; runs inside an OCR worker process"""
+    doc = fitz.open(pdf_path)
+    try:
+        pix = doc[page_index].get_pixmap(dpi=300)
+        image = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+        pix = None  # Drop the raw samples before Tesseract allocates its own copy
+    finally:
+        doc.close()
+    return pytesseract.image_to_string(image, config='--psm 6')
+
+def _open_pdf_sync(file_content: bytes) -> fitz.Document:
+    return fitz.open(stream=file_content, filetype="pdf")
+
+def _spool_pdf_sync(file_content: bytes) -> str:
+    """Write the PDF to a temporary file that worker processes can open lazily from disk"""
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+        f.write(file_content)
+        return f.name
+
+def _is_scanned_sync(doc: fitz.Document) -> bool:
+    total_chars = 0
+    has_images = False
+    
+    for page_num in range(min(3, len(doc))):  # Check first 3 pages
+        page = doc[page_num]
+        total_chars += len(page.get_text().strip())
+        
+        # Enough text already means it is not scanned; skip the remaining pages
+        if total_chars >= 100:
+            return False
+        
+        # Only look for images while text is still sparse
+        if not has_images:
+            has_images = len(page.get_images()) > 0
+    
+    # If very little text but some images, likely scanned
+    return has_images
+
+# Worker processes are spawned rather than forked, since forking a process that
+# already runs threads (executors, to_thread, httpx) can deadlock the children
+_SPAWN = multiprocessing.get_context("spawn")
+
+# Worker count and page threshold for parallel page-range extraction
+_PDF_WORKERS = min(os.cpu_count() or 1, 4)
+_PDF_PARALLEL_MIN_PAGES = 16
+
+def _pymupdf_pages(doc: fitz.Document, start: int, stop: int) -> List[str]:
+    text_parts = []
+    
+    for page_num in range(start, stop):
+        page = doc[page_num]
+        
+        # Extract text with layout preservation
+        page_parts = [page.get_text("text")]
+        
+        # Also try to extract tables
+        tables = page.find_tables()
+        for table in tables:
+            try:
+                table_data = table.extract()
+                if table_data:
+                    table_text = "\n".join(["\t".join(row) for row in table_data if row])
+                    page_parts.append(f"Table:\n{table_text}")
+            except:
+                pass
+        
+        text = "\n\n".join(page_parts)
+        if text.strip():
+            text_parts.append(f"--- Page {page_num + 1} ---\n{text.strip()}")
+    
+    return text_parts
+
+def _pymupdf_sync(doc: fitz.Document) -> str:
+    return "\n\n".join(_pymupdf_pages(doc, 0, len(doc)))
+
+def _pymupdf_range(pdf_path: str, start: int, stop: int) -> List[str]:
+    """Extract a range of pages; runs inside a PDF worker process"""
+    doc = fitz.open(pdf_path)
+    try:
+        return _pymupdf_pages(doc, start, stop)
+    finally:
+        doc.close()
+
+def _basic_text_sync(doc: fitz.Document) -> str:
+    return "\n".join(page.get_text() for page in doc).strip()
 
 class AdvancedDocumentParser:
     def __init__(self):
@@ -20,73 +119,116 @@ class AdvancedDocumentParser:
         self.unstructured_api_key = os.getenv("UNSTRUCTURED_API_KEY")
         self.unstructured_url = os.getenv("UNSTRUCTURED_API_URL", "https://api.unstructured.io")
         
-    async def parse_document(self, file_content: bytes, filename: str, file_url: Optional[str] = None) -> str:
+        # Shared connection pool so repeated parses reuse keep-alive connections
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100),
+            timeout=httpx.Timeout(60.0),
+            http2=True
+        )
+        
+        # Cap in-flight calls per provider to stay inside their concurrency budgets
+        self._llama_sem = asyncio.Semaphore(int(os.getenv("LLAMA_MAX_CONC", "8")))
+        self._unstructured_sem = asyncio.Semaphore(int(os.getenv("UNSTRUCTURED_MAX_CONC", "8")))
+        
+        # Tesseract is CPU-bound, so OCR pages are spread across worker processes
+        ocr_concurrency = int(os.getenv("OCR_CONCURRENCY", str(os.cpu_count() or 4)))
+        self._ocr_pool = ProcessPoolExecutor(max_workers=ocr_concurrency, mp_context=_SPAWN)
+        self._ocr_sem = asyncio.Semaphore(ocr_concurrency)
+        
+        # Large PDFs are split into page ranges extracted in parallel worker processes
+        self._pdf_pool = ProcessPoolExecutor(max_workers=_PDF_WORKERS, mp_context=_SPAWN)
+        
+        # PyMuPDF parsing is blocking, so it runs off the event loop. MuPDF is not thread-safe,
+        # so all in-process fitz calls share one worker thread
+        self._cpu_pool = ThreadPoolExecutor(max_workers=1)
+    
+    async def aclose(self):
+        """Close the pooled HTTP client and stop the OCR and PDF workers"""
+        await self._client.aclose()
+        self._ocr_pool.shutdown()
+        self._pdf_pool.shutdown()
+        self._cpu_pool.shutdown()
+    
+    async def _run_blocking(self, func, *args):
+        """Run a blocking PDF helper on the CPU thread pool"""
+        return await asyncio.get_running_loop().run_in_executor(self._cpu_pool, func, *args)
+        
+    async def parse_document(self, file_content: Optional[bytes], filename: str, file_url: Optional[str] = None, skip_remote: bool = False) -> str:
         """
         Parse document using advanced parsing methods with fallback strategy:
         1. Try LlamaParse (best for complex layouts)
         2. Try Unstructured API (good for structured documents)
         3. Try OCR if document appears to be scanned
         4. Fallback to basic PyMuPDF extraction
+        
+        When file_content is None, only the parsing APIs are tried, fetching the
+        file from file_url; an empty string means the caller should fall back to
+        downloading the bytes. Set skip_remote when that URL attempt already failed.
         """
+        if file_content is None:
+            return await self._parse_remote(None, filename, file_url) or ""
+        
+        doc = None
         try:
+            # Open the PDF once and share it across scan detection and local extraction
+            doc = await self._run_blocking(_open_pdf_sync, file_content)
+            
             # First, check if document is scanned/image-based
-            is_scanned = await self._is_scanned_document(file_content)
+            is_scanned = await self._is_scanned_document(doc)
             
             if is_scanned:
                 print("Document appears to be scanned, using OCR...")
-                return await self._extract_with_ocr(file_content)
-            
-            # Try LlamaParse first (best for complex medical documents)
-            if self.llama_parse_api_key:
-                try:
-                    result = await self._parse_with_llama_parse(file_content, filename)
-                    if result:
-                        return result
-                except Exception as e:
-                    print(f"LlamaParse failed: {e}")
+                return await self._extract_with_ocr(file_content, doc)
             
-            # Try Unstructured API
-            if self.unstructured_api_key:
-                try:
-                    result = await self._parse_with_unstructured(file_content, filename, file_url)
-                    if result:
-                        return result
-                except Exception as e:
-                    print(f"Unstructured API failed: {e}")
+            if not skip_remote:
+                result = await self._parse_remote(file_content, filename, file_url)
+                if result:
+                    return result
             
             # Fallback to PyMuPDF with enhanced extraction
-            return await self._extract_with_pymupdf(file_content)
+            return await self._extract_with_pymupdf(file_content, doc)
             
         except Exception as e:
             print(f"All parsing methods failed: {e}")
             # Final fallback to basic text extraction
-            return await self._basic_text_extraction(file_content)
+            return await self._basic_text_extraction(doc)
+        finally:
+            if doc is not None:
+                await self._run_blocking(doc.close)
+    
+    async def _parse_remote(self, file_content: Optional[bytes], filename: str, file_url: Optional[str] = None) -> Optional[str]:
+        """Try the configured parsing APIs in order, returning the first non-empty result"""
+        # Try LlamaParse first (best for complex medical documents)
+        if self.llama_parse_api_key:
+            try:
+                async with self._llama_sem:
+                    result = await self._parse_with_llama_parse(file_content, filename, file_url)
+                if result:
+                    return result
+            except Exception as e:
+                print(f"LlamaParse failed: {e}")
+        
+        # Try Unstructured API
+        if self.unstructured_api_key:
+            try:
+                async with self._unstructured_sem:
+                    result = await self._parse_with_unstructured(file_content, filename, file_url)
+                if result:
+                    return result
+            except Exception as e:
+                print(f"Unstructured API failed: {e}")
+        
+        return None
     
-    async def _is_scanned_document(self, file_content: bytes) -> bool:
+    async def _is_scanned_document(self, doc: fitz.Document) -> bool:
         """Check if PDF is primarily image-based (scanned)"""
         try:
-            doc = fitz.open(stream=file_content, filetype="pdf")
-            total_chars = 0
-            total_images = 0
-            
-            for page_num in range(min(3, len(doc))):  # Check first 3 pages
-                page = doc[page_num]
-                text = page.get_text()
-                images = page.get_images()
-                
-                total_chars += len(text.strip())
-                total_images += len(images)
-            
-            doc.close()
-            
-            # If very little text but many images, likely scanned
-            return total_chars < 100 and total_images > 0
-            
+            return await self._run_blocking(_is_scanned_sync, doc)
         except Exception:
             return False
     
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-    async def _parse_with_llama_parse(self, file_content: bytes, filename: str) -> Optional[str]:
+    @retry(stop=stop_after_attempt(3), wait=wait_random_exponential(min=1, max=10), retry=retry_if_exception(_is_transient))
+    async def _parse_with_llama_parse(self, file_content: Optional[bytes], filename: str, file_url: Optional[str] = None) -> Optional[str]:
         """Parse document using LlamaParse API"""
         url = "https://api.cloud.llamaindex.ai/api/parsing/upload"
         
@@ -94,45 +236,68 @@ class AdvancedDocumentParser:
             "Authorization": f"Bearer {self.llama_parse_api_key}",
         }
         
-        files = {
-            "file": (filename, file_content, "application/pdf")
-        }
-        
         data = {
             "parsing_instruction": "Extract all text content from this medical document, preserving structure and formatting. Include headers, sections, tables, and any medical data.",
             "result_type": "text"
         }
         
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            # Upload document
-            response = await client.post(url, headers=headers, files=files, data=data)
-            response.raise_for_status()
-            
-            job_data = response.json()
-            job_id = job_data.get("id")
-            
-            if not job_id:
-                return None
+        # Let LlamaParse fetch the file itself when we only have its URL
+        if file_content is None:
+            files = None
+            data["input_url"] = file_url
+        else:
+            files = {
+                "file": (filename, file_content, "application/pdf")
+            }
+        
+        # Upload document
+        response = await self._client.post(url, headers=headers, files=files, data=data)
+        response.raise_for_status()
+        
+        job_data = orjson.loads(response.content)
+        job_id = job_data.get("id")
+        
+        if not job_id:
+            return None
+        
+        # Poll for results
+        result_url = f"https://api.cloud.llamaindex.ai/api/parsing/job/{job_id}/result/text"
+        
+        # Start polling quickly and back off, so short jobs return promptly
+        min_delay, max_delay = 0.5, 5.0
+        delay = min_delay
+        deadline = time.monotonic() + 300  # Wait up to 5 minutes
+        
+        while time.monotonic() < deadline:
+            await asyncio.sleep(min(delay, max(deadline - time.monotonic(), 0)))
             
-            # Poll for results
-            result_url = f"https://api.cloud.llamaindex.ai/api/parsing/job/{job_id}/result/text"
+            result_response = await self._client.get(result_url, headers=headers)
             
-            for _ in range(30):  # Wait up to 5 minutes
-                await asyncio.sleep(10)
-                
-                result_response = await client.get(result_url, headers=headers)
-                
-                if result_response.status_code == 200:
-                    result_data = result_response.json()
-                    if result_data.get("status") == "SUCCESS":
-                        return result_data.get("text", "")
-                elif result_response.status_code != 202:  # Not still processing
-                    break
+            if result_response.status_code == 200:
+                result_data = orjson.loads(result_response.content)
+                if result_data.get("status") == "SUCCESS":
+                    return result_data.get("text", "")
+            elif result_response.status_code != 202:  # Not still processing
+                break
             
+            # Honor a server hint, but never tight-poll or wait past our own backoff cap
+            hint = self._poll_hint(result_response)
+            delay = min(max(hint, min_delay), max_delay) if hint is not None else min(delay * 1.5, max_delay)
+        
+        return None
+    
+    @staticmethod
+    def _poll_hint(response: httpx.Response) -> Optional[float]:
+        """Read a Retry-After wait hint given in seconds; HTTP-date values are ignored"""
+        # estimated_completion is not used: it is not documented as a relative number of seconds
+        try:
+            value = float(response.headers["Retry-After"])
+        except (KeyError, ValueError):
             return None
+        return value if math.isfinite(value) else None
     
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-    async def _parse_with_unstructured(self, file_content: bytes, filename: str, file_url: Optional[str] = None) -> Optional[str]:
+    @retry(stop=stop_after_attempt(3), wait=wait_random_exponential(min=1, max=10), retry=retry_if_exception(_is_transient))
+    async def _parse_with_unstructured(self, file_content: Optional[bytes], filename: str, file_url: Optional[str] = None) -> Optional[str]:
         """Parse document using Unstructured API"""
         url = f"{self.unstructured_url}/general/v0/general"
         
@@ -149,8 +314,7 @@ class AdvancedDocumentParser:
                 "extract_image_block_types": '["Image", "Table"]'
             }
             
-            async with httpx.AsyncClient(timeout=60.0) as client:
-                response = await client.post(url, headers=headers, data=data)
+            response = await self._client.post(url, headers=headers, data=data)
         else:
             files = {
                 "files": (filename, file_content, "application/pdf")
@@ -162,11 +326,10 @@ class AdvancedDocumentParser:
                 "extract_image_block_types": '["Image", "Table"]'
             }
             
-            async with httpx.AsyncClient(timeout=60.0) as client:
-                response = await client.post(url, headers=headers, files=files, data=data)
+            response = await self._client.post(url, headers=headers, files=files, data=data)
         
         response.raise_for_status()
-        elements = response.json()
+        elements = orjson.loads(response.content)
         
         # Combine all text elements
         text_parts = []
@@ -178,17 +341,30 @@ class AdvancedDocumentParser:
         
         return "\n\n".join(text_parts) if text_parts else None
     
-    async def _extract_with_ocr(self, file_content: bytes) -> str:
+    async def _extract_with_ocr(self, file_content: bytes, doc: fitz.Document) -> str:
         """Extract text using OCR for scanned documents"""
         try:
-            # Convert PDF to images
-            images = convert_from_bytes(file_content, dpi=300)
+            # Pages are rendered one at a time inside the workers, so only the
+            # pages currently being OCRed are held in memory as images
+            page_count = await self._run_blocking(len, doc)
             
-            extracted_text = []
+            # Use Tesseract OCR on all pages in parallel
+            loop = asyncio.get_running_loop()
+            
+            # Workers open the PDF from disk instead of each receiving a pickled copy of the bytes
+            pdf_path = await asyncio.to_thread(_spool_pdf_sync, file_content)
+            
+            async def ocr(page_index: int) -> str:
+                async with self._ocr_sem:
+                    return await loop.run_in_executor(self._ocr_pool, _ocr_page, pdf_path, page_index)
+            
+            try:
+                page_texts = await asyncio.gather(*[ocr(i) for i in range(page_count)])
+            finally:
+                os.unlink(pdf_path)
             
-            for i, image in enumerate(images):
-                # Use Tesseract OCR
-                text = pytesseract.image_to_string(image, config='--psm 6')
+            extracted_text = []
+            for i, text in enumerate(page_texts):
                 if text.strip():
                     extracted_text.append(f"--- Page {i+1} ---\n{text.strip()}")
             
@@ -196,64 +372,55 @@ class AdvancedDocumentParser:
             
         except Exception as e:
             print(f"OCR extraction failed: {e}")
-            return await self._extract_with_pymupdf(file_content)
+            return await self._extract_with_pymupdf(file_content, doc)
     
-    async def _extract_with_pymupdf(self, file_content: bytes) -> str:
+    async def _extract_with_pymupdf(self, file_content: bytes, doc: fitz.Document) -> str:
         """Enhanced text extraction using PyMuPDF"""
         try:
-            doc = fitz.open(stream=file_content, filetype="pdf")
-            text_parts = []
+            page_count = await self._run_blocking(len, doc)
+            if page_count < _PDF_PARALLEL_MIN_PAGES:
+                return await self._run_blocking(_pymupdf_sync, doc)
             
-            for page_num in range(len(doc)):
-                page = doc[page_num]
-                
-                # Extract text with layout preservation
-                text = page.get_text("text")
-                
-                # Also try to extract tables
-                tables = page.find_tables()
-                for table in tables:
-                    try:
-                        table_data = table.extract()
-                        if table_data:
-                            table_text = "\n".join(["\t".join(row) for row in table_data if row])
-                            text += f"\n\nTable:\n{table_text}\n"
-                    except:
-                        pass
-                
-                if text.strip():
-                    text_parts.append(f"--- Page {page_num + 1} ---\n{text.strip()}")
+            # Pages are independent, so give each worker process a contiguous range
+            loop = asyncio.get_running_loop()
+            step = -(-page_count // _PDF_WORKERS)
+            ranges = [(start, min(start + step, page_count)) for start in range(0, page_count, step)]
             
-            doc.close()
-            return "\n\n".join(text_parts)
+            # Spooling only writes bytes, so it need not wait behind fitz work
+            pdf_path = await asyncio.to_thread(_spool_pdf_sync, file_content)
+            try:
+                results = await asyncio.gather(*[
+                    loop.run_in_executor(self._pdf_pool, _pymupdf_range, pdf_path, start, stop)
+                    for start, stop in ranges
+                ])
+            finally:
+                os.unlink(pdf_path)
+            return "\n\n".join(part for parts in results for part in parts)
             
         except Exception as e:
             print(f"PyMuPDF extraction failed: {e}")
-            return await self._basic_text_extraction(file_content)
+            return await self._basic_text_extraction(doc)
     
-    async def _basic_text_extraction(self, file_content: bytes) -> str:
+    async def _basic_text_extraction(self, doc: Optional[fitz.Document]) -> str:
         """Basic fallback text extraction"""
         try:
-            import PyPDF2
-            pdf_file = BytesIO(file_content)
-            pdf_reader = PyPDF2.PdfReader(pdf_file)
-            
-            text = ""
-            for page in pdf_reader.pages:
-                text += page.extract_text() + "\n"
-            
-            return text.strip()
+            return await self._run_blocking(_basic_text_sync, doc)
         except Exception as e:
             return f"Failed to extract text from document: {str(e)}"
     
     async def get_signed_url_from_supabase(self, supabase_client, file_path: str, expires_in: int = 3600) -> Optional[str]:
         """Generate a signed URL for the file in Supabase Storage"""
         try:
-            response = supabase_client.storage.from_("reports").create_signed_url(file_path, expires_in)
+            response = await asyncio.to_thread(
+                supabase_client.storage.from_("reports").create_signed_url, file_path, expires_in
+            )
             return response.get("signedURL")
         except Exception as e:
             print(f"Failed to create signed URL: {e}")
             return None
 
-# Global instance
-advanced_parser = AdvancedDocumentParser()
+# The parser is built on first use, so importing this module does no setup work
+@lru_cache(maxsize=1)
+def get_advanced_parser() -> AdvancedDocumentParser:
+    load_dotenv()
+    return AdvancedDocumentParser()
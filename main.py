@@ -1,10 +1,15 @@
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Depends
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Depends, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import Response, StreamingResponse, RedirectResponse
 import uuid
-from datetime import datetime
-from typing import Optional
+import os
+from datetime import datetime, timezone
+from typing import Optional, Dict, List
 import asyncio
+import base64
+import hashlib
+import orjson
 
 from models import (
     SummarizeReportRequest, SymptomChatRequest, TTSRequest,
@@ -12,8 +17,8 @@ from models import (
     HistoryResponse, UploadResponse, TTSResponse, MessageType
 )
 from database import supabase_client
-from services import llm_service, pdf_parser, tts_service
-from document_parser import advanced_parser
+from services import get_llm_service, get_tts_service, load_tokenizer, PromptTooLargeError
+from document_parser import get_advanced_parser
 
 app = FastAPI(
     title="SymptoScan API",
@@ -37,6 +42,42 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+class SelectiveGZipMiddleware(GZipMiddleware):
+    """Gzip responses except for routes that return already-compressed media or stream incrementally"""
+    
+    skip_paths = {"/tts", "/summarize-report/stream"}
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in self.skip_paths:
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+app.add_middleware(SelectiveGZipMiddleware, minimum_size=1000)
+
+# Column projections matching the response models, so queries skip unused columns
+# Documents store their path in storage_url, exposed to clients as file_path
+DOCUMENT_COLUMNS = ",".join("file_path:storage_url" if field == "file_path" else field for field in DocumentResponse.model_fields)
+SUMMARY_COLUMNS = ",".join(SummaryResponse.model_fields)
+MESSAGE_COLUMNS = ",".join(MessageResponse.model_fields)
+
+@app.on_event("startup")
+async def load_tokenizer_on_startup():
+    """Load the tiktoken encoding before serving, so its first-use download never runs on the event loop"""
+    try:
+        await asyncio.to_thread(load_tokenizer)
+    except Exception as e:
+        # Keep serving without it; token counting runs in worker threads and retries the load there
+        print(f"Failed to preload tokenizer: {e}")
+
+@app.on_event("shutdown")
+async def close_http_clients():
+    """Release pooled HTTP connections held by the external API services"""
+    # Only close services that were actually created
+    for get_service in (get_llm_service, get_tts_service, get_advanced_parser):
+        if get_service.cache_info().currsize:
+            await get_service().aclose()
+
 @app.get("/")
 async def root():
     return {"message": "SymptoScan API is running", "version": "1.0.0"}
@@ -52,9 +93,10 @@ async def upload_report(
         if not file.content_type or not file.content_type.startswith(('application/pdf', 'image/', 'text/')):
             raise HTTPException(status_code=400, detail="Invalid file type. Only PDF, image, and text files are allowed.")
         
-        # Read file content
-        file_content = await file.read()
-        file_size = len(file_content)
+        # Measure size without reading the spooled upload into memory
+        file_size = file.size
+        if file_size is None:
+            file_size = os.fstat(file.file.fileno()).st_size
         
         # Generate unique filename
         file_extension = file.filename.split('.')[-1] if '.' in file.filename else 'pdf'
@@ -62,32 +104,39 @@ async def upload_report(
         
         # Upload to Supabase Storage
         supabase = supabase_client.get_client()
-        storage_response = supabase.storage.from_("reports").upload(
-            path=unique_filename,
-            file=file_content,
-            file_options={"content-type": file.content_type}
-        )
+        # storage3 only streams bytes or real files, so reopen the spooled
+        # upload's descriptor as a BufferedReader instead of reading it
+        reader = open(file.file.fileno(), "rb", closefd=False)
+        try:
+            reader.seek(0)
+            storage_response = await asyncio.to_thread(
+                supabase.storage.from_("reports").upload,
+                path=unique_filename,
+                file=reader,
+                file_options={"content-type": file.content_type}
+            )
+        finally:
+            reader.close()
         
         if hasattr(storage_response, 'error') and storage_response.error:
             raise HTTPException(status_code=500, detail=f"Failed to upload file: {storage_response.error}")
         
         # Create document record in database
+        # id and upload_date are filled in by the database defaults
         document_data = {
-            "id": str(uuid.uuid4()),
             "user_id": user_id,
             "filename": file.filename,
             "storage_url": f"reports/{unique_filename}",
-            "upload_date": datetime.utcnow().isoformat(),
             "file_size": file_size
         }
         
-        db_response = supabase.table("documents").insert(document_data).execute()
+        db_response = await asyncio.to_thread(supabase.table("documents").insert(document_data).execute)
         
         if hasattr(db_response, 'error') and db_response.error:
             raise HTTPException(status_code=500, detail=f"Failed to create document record: {db_response.error}")
         
         return UploadResponse(
-            document_id=document_data["id"],
+            document_id=db_response.data[0]["id"],
             message="File uploaded successfully",
             file_path=unique_filename
         )
@@ -95,17 +144,51 @@ async def upload_report(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
 
+# Summaries currently being generated, so duplicate requests share one pipeline run
+_inflight_summaries: Dict[str, asyncio.Task] = {}
+
 @app.post("/summarize-report", response_model=SummaryResponse)
-async def summarize_report(request: SummarizeReportRequest):
-    """Summarize a medical report using LLM"""
+async def summarize_report(request: SummarizeReportRequest, force: bool = False):
+    """Summarize a medical report using LLM.
+    
+    Returns the stored summary for a document when one exists; pass force=true to regenerate it.
+    """
+    if request.document_id:
+        key = f"document:{request.document_id}:{force}"
+    elif request.parsed_text:
+        key = f"text:{hashlib.sha1(request.parsed_text.encode()).hexdigest()}"
+    else:
+        return await _summarize_report(request, force)
+    
+    task = _inflight_summaries.get(key)
+    if task is None:
+        task = asyncio.create_task(_summarize_report(request, force))
+        _inflight_summaries[key] = task
+        task.add_done_callback(lambda _: _inflight_summaries.pop(key, None))
+    
+    # Shield so one caller disconnecting does not cancel the run for the others
+    return await asyncio.shield(task)
+
+async def _summarize_report(request: SummarizeReportRequest, force: bool = False) -> SummaryResponse:
     try:
         text_to_analyze = ""
         document_id = None
         
         if request.document_id:
-            # Get document from database
             supabase = supabase_client.get_client()
-            doc_response = supabase.table("documents").select("*").eq("id", request.document_id).execute()
+            
+            # Reuse the latest stored summary instead of re-running the pipeline
+            if not force:
+                existing = await asyncio.to_thread(
+                    supabase.table("summaries").select(SUMMARY_COLUMNS).eq("document_id", request.document_id).order("created_at", desc=True).limit(1).execute
+                )
+                if existing.data:
+                    return SummaryResponse(**existing.data[0])
+            
+            # Get document from database
+            doc_response = await asyncio.to_thread(
+                supabase.table("documents").select("*").eq("id", request.document_id).execute
+            )
             
             if not doc_response.data:
                 raise HTTPException(status_code=404, detail="Document not found")
@@ -113,28 +196,39 @@ async def summarize_report(request: SummarizeReportRequest):
             document = doc_response.data[0]
             document_id = document["id"]
             
-            # Download file from Supabase Storage
-            file_response = supabase.storage.from_("reports").download(document["storage_url"])
-            
-            if hasattr(file_response, 'error') and file_response.error:
-                raise HTTPException(status_code=500, detail=f"Failed to download file: {file_response.error}")
+            is_pdf = document["filename"].lower().endswith('.pdf')
             
             # Generate signed URL for advanced parsing APIs
             signed_url = None
-            try:
-                signed_url = await advanced_parser.get_signed_url_from_supabase(supabase, document["storage_url"])
-            except Exception as e:
-                print(f"Failed to generate signed URL: {e}")
+            if is_pdf:
+                try:
+                    signed_url = await get_advanced_parser().get_signed_url_from_supabase(supabase, document["storage_url"])
+                except Exception as e:
+                    print(f"Failed to generate signed URL: {e}")
+            
+            # Let the parsing APIs fetch the PDF straight from storage when possible
+            if signed_url:
+                text_to_analyze = await get_advanced_parser().parse_document(None, document["filename"], signed_url)
             
-            # Parse document using advanced methods
-            if document["filename"].lower().endswith('.pdf'):
-                text_to_analyze = await pdf_parser.parse_pdf(
-                    file_response, 
-                    document["filename"], 
-                    signed_url
+            if not text_to_analyze:
+                # Download file from Supabase Storage
+                file_response = await asyncio.to_thread(
+                    supabase.storage.from_("reports").download, document["storage_url"]
                 )
-            else:
-                text_to_analyze = file_response.decode('utf-8')
+                
+                if hasattr(file_response, 'error') and file_response.error:
+                    raise HTTPException(status_code=500, detail=f"Failed to download file: {file_response.error}")
+                
+                # Parse document using advanced methods
+                if is_pdf:
+                    text_to_analyze = await get_advanced_parser().parse_document(
+                        file_response, 
+                        document["filename"], 
+                        signed_url,
+                        skip_remote=bool(signed_url)
+                    )
+                else:
+                    text_to_analyze = file_response.decode('utf-8')
                 
         elif request.parsed_text:
             text_to_analyze = request.parsed_text
@@ -143,66 +237,101 @@ async def summarize_report(request: SummarizeReportRequest):
             raise HTTPException(status_code=400, detail="Either document_id or parsed_text must be provided")
         
         # Call LLM for summarization
-        summary_data = await llm_service.summarize_report(text_to_analyze)
+        summary_data = await get_llm_service().summarize_report(text_to_analyze)
         
         # Save summary to database
+        # id and created_at are filled in by the database defaults
         summary_record = {
-            "id": str(uuid.uuid4()),
             "document_id": document_id,
             "summary_text": summary_data.get("summary_text", ""),
             "key_findings": summary_data.get("key_findings", []),
-            "recommendations": summary_data.get("recommendations", []),
-            "created_at": datetime.utcnow().isoformat()
+            "recommendations": summary_data.get("recommendations", [])
         }
         
         supabase = supabase_client.get_client()
-        db_response = supabase.table("summaries").insert(summary_record).execute()
+        db_response = await asyncio.to_thread(supabase.table("summaries").insert(summary_record).execute)
         
         if hasattr(db_response, 'error') and db_response.error:
             raise HTTPException(status_code=500, detail=f"Failed to save summary: {db_response.error}")
         
-        return SummaryResponse(**summary_record)
+        return SummaryResponse(**db_response.data[0])
         
+    except PromptTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Summarization failed: {str(e)}")
 
+@app.post("/summarize-report/stream")
+async def stream_summarize_report(request: SummarizeReportRequest):
+    """Stream the summary JSON for raw report text as it is generated.
+    
+    The body is newline-delimited JSON: {"delta": ...} pieces of the summary text, then
+    {"done": true}, or {"error": ...} if generation fails after streaming has begun.
+    Only parsed_text is supported and the summary is not saved; use /summarize-report to store it.
+    """
+    if not request.parsed_text:
+        raise HTTPException(status_code=400, detail="parsed_text must be provided")
+    
+    try:
+        # Wait for the first piece so upstream failures still return an error status
+        summary_stream = get_llm_service().stream_summary(request.parsed_text)
+        first = await summary_stream.__anext__()
+    except PromptTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Summarization failed: {str(e)}")
+    
+    async def body():
+        try:
+            yield orjson.dumps({"delta": first}) + b"\n"
+            async for delta in summary_stream:
+                yield orjson.dumps({"delta": delta}) + b"\n"
+        except Exception as e:
+            # The status line is already sent, so report the failure in the body
+            yield orjson.dumps({"error": f"Summarization failed: {str(e)}"}) + b"\n"
+            return
+        yield orjson.dumps({"done": True}) + b"\n"
+    
+    return StreamingResponse(body(), media_type="application/x-ndjson")
+
 @app.post("/symptom-chat", response_model=ChatResponse)
 async def symptom_chat(request: SymptomChatRequest):
     """Analyze symptoms and provide medical guidance"""
     try:
-        # Save user message
+        # ids come from the database default; timestamps are set here because both
+        # messages are inserted together and would otherwise share the same now()
         user_message = {
-            "id": str(uuid.uuid4()),
             "user_id": request.user_id,
             "message_type": MessageType.USER,
             "content": request.message,
-            "created_at": datetime.utcnow().isoformat()
+            "metadata": None,
+            "created_at": datetime.now(timezone.utc).isoformat(timespec="milliseconds")
         }
         
         supabase = supabase_client.get_client()
-        supabase.table("messages").insert(user_message).execute()
         
         # Get user's recent medical history for context
-        history_response = supabase.table("messages").select("content").eq("user_id", request.user_id).order("created_at", desc=True).limit(10).execute()
+        history_response = await asyncio.to_thread(
+            supabase.table("messages").select("content").eq("user_id", request.user_id).order("created_at", desc=True).limit(10).execute
+        )
         
         user_history = ""
         if history_response.data:
             user_history = " ".join([msg["content"] for msg in history_response.data])
         
         # Analyze symptoms with LLM
-        analysis = await llm_service.analyze_symptoms(request.message, user_history)
+        analysis = await get_llm_service().analyze_symptoms(request.message, user_history)
         
-        # Save AI response
         ai_message = {
-            "id": str(uuid.uuid4()),
             "user_id": request.user_id,
             "message_type": MessageType.AI,
             "content": f"Analysis: {analysis}",
             "metadata": analysis,
-            "created_at": datetime.utcnow().isoformat()
+            "created_at": datetime.now(timezone.utc).isoformat(timespec="milliseconds")
         }
         
-        supabase.table("messages").insert(ai_message).execute()
+        # Save user message and AI response in a single round-trip
+        await asyncio.to_thread(supabase.table("messages").insert([user_message, ai_message]).execute)
         
         return ChatResponse(
             possible_conditions=analysis.get("possible_conditions", []),
@@ -210,34 +339,90 @@ async def symptom_chat(request: SymptomChatRequest):
             recommended_actions=analysis.get("recommended_actions", [])
         )
         
+    except PromptTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Symptom analysis failed: {str(e)}")
 
+def _encode_history_cursor(positions: Dict[str, Optional[List[str]]]) -> str:
+    return base64.urlsafe_b64encode(orjson.dumps(positions)).decode()
+
+def _decode_history_cursor(cursor: str) -> Dict[str, Optional[List[str]]]:
+    positions = orjson.loads(base64.urlsafe_b64decode(cursor.encode()))
+    
+    # Re-serialize each position so only a real timestamp and UUID reach the query filter
+    decoded = {}
+    for stream in ("documents", "messages"):
+        position = positions[stream]
+        if position is not None:
+            timestamp, row_id = position
+            position = [datetime.fromisoformat(timestamp).isoformat(), str(uuid.UUID(row_id))]
+        decoded[stream] = position
+    return decoded
+
+def _history_page(query, time_column: str, position: List[str], limit: int):
+    """Order newest first and continue strictly after a (timestamp, id) position, so rows tied at a page boundary are kept"""
+    if position:
+        timestamp, row_id = position
+        query = query.or_(f'{time_column}.lt."{timestamp}",and({time_column}.eq."{timestamp}",id.lt.{row_id})')
+    return query.order(time_column, desc=True).order("id", desc=True).limit(limit)
+
 @app.get("/history/{user_id}", response_model=HistoryResponse)
-async def get_user_history(user_id: str):
-    """Get user's complete history including documents, summaries, and messages"""
+async def get_user_history(
+    user_id: str,
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None
+):
+    """Get a page of the user's history including documents, summaries, and messages.
+    
+    Pass the returned next_cursor as cursor to fetch older entries. The cursor tracks
+    documents and messages separately, so each stream continues from its own last row.
+    """
+    # Each stream maps to its last (timestamp, id), [] before the first page, or None once exhausted
+    positions = {"documents": [], "messages": []}
+    if cursor:
+        try:
+            positions = _decode_history_cursor(cursor)
+        except Exception:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    
     try:
         supabase = supabase_client.get_client()
         
-        # Get documents
-        docs_response = supabase.table("documents").select("*").eq("user_id", user_id).order("upload_date", desc=True).execute()
-        documents = [DocumentResponse(**doc) for doc in docs_response.data] if docs_response.data else []
+        async def fetch(table: str, columns: str, time_column: str):
+            if positions[table] is None:
+                return []
+            query = supabase.table(table).select(columns).eq("user_id", user_id)
+            response = await asyncio.to_thread(_history_page(query, time_column, positions[table], limit).execute)
+            return response.data or []
         
-        # Get summaries for user's documents
+        # Get documents and messages concurrently; the sync client runs each query in a worker thread
+        docs_data, messages_data = await asyncio.gather(
+            fetch("documents", DOCUMENT_COLUMNS, "upload_date"),
+            fetch("messages", MESSAGE_COLUMNS, "created_at")
+        )
+        documents = [DocumentResponse(**doc) for doc in docs_data]
+        messages = [MessageResponse(**msg) for msg in messages_data]
+        
+        # Get every summary for this page of documents
         doc_ids = [doc.id for doc in documents]
         summaries = []
         if doc_ids:
-            summaries_response = supabase.table("summaries").select("*").in_("document_id", doc_ids).order("created_at", desc=True).execute()
+            summaries_response = await asyncio.to_thread(supabase.table("summaries").select(SUMMARY_COLUMNS).in_("document_id", doc_ids).order("created_at", desc=True).execute)
             summaries = [SummaryResponse(**summary) for summary in summaries_response.data] if summaries_response.data else []
         
-        # Get messages
-        messages_response = supabase.table("messages").select("*").eq("user_id", user_id).order("created_at", desc=True).execute()
-        messages = [MessageResponse(**msg) for msg in messages_response.data] if messages_response.data else []
+        # A short page means that stream has no older rows
+        next_positions = {
+            "documents": [documents[-1].upload_date.isoformat(), documents[-1].id] if len(documents) == limit else None,
+            "messages": [messages[-1].created_at.isoformat(), messages[-1].id] if len(messages) == limit else None
+        }
+        next_cursor = _encode_history_cursor(next_positions) if any(next_positions.values()) else None
         
         return HistoryResponse(
             documents=documents,
             summaries=summaries,
-            messages=messages
+            messages=messages,
+            next_cursor=next_cursor
         )
         
     except Exception as e:
@@ -247,12 +432,34 @@ async def get_user_history(user_id: str):
 async def text_to_speech(request: TTSRequest):
     """Convert text to speech using ElevenLabs API"""
     try:
-        # Generate audio
-        audio_data = await tts_service.text_to_speech(request.text)
+        # Serve audio generated on this host without another network round-trip
+        local_audio = await get_tts_service().get_local_audio(request.text)
+        if local_audio is not None:
+            return Response(
+                content=local_audio,
+                media_type="audio/mpeg",
+                headers={"Content-Disposition": "attachment; filename=speech.mp3"}
+            )
+        
+        # Send the browser straight to previously generated audio in storage
+        cached_url = await get_tts_service().get_cached_url(request.text)
+        if cached_url:
+            return RedirectResponse(cached_url, status_code=303)
+        
+        # Wait for the first audio chunk so upstream failures still return an error status
+        audio_stream = get_tts_service().stream_tts(request.text)
+        first = await audio_stream.__anext__()
+        
+        async def body():
+            try:
+                yield first
+                async for chunk in audio_stream:
+                    yield chunk
+            finally:
+                await audio_stream.aclose()
         
-        # Return audio data directly
-        return Response(
-            content=audio_data,
+        return StreamingResponse(
+            body(),
             media_type="audio/mpeg",
             headers={"Content-Disposition": "attachment; filename=speech.mp3"}
         )
@@ -263,7 +470,7 @@ async def text_to_speech(request: TTSRequest):
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return {"status": "healthy", "timestamp": datetime.utcnow().isoformat()}
+    return {"status": "healthy", "timestamp": datetime.now(timezone.utc).isoformat()}
 
 if __name__ == "__main__":
     import uvicorn
@@ -59,6 +59,7 @@ class HistoryResponse(BaseModel):
     documents: List[DocumentResponse]
     summaries: List[SummaryResponse]
     messages: List[MessageResponse]
+    next_cursor: Optional[str] = None
 
 class UploadResponse(BaseModel):
     document_id: str
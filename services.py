@@ -1,185 +1,422 @@
 import os
-import json
+import asyncio
+import hashlib
 import httpx
-import PyPDF2
-from io import BytesIO
-from typing import Dict, Any, List, Optional
-from tenacity import retry, stop_after_attempt, wait_exponential
-from openai import OpenAI
+import orjson
+import tiktoken
+import diskcache
+from functools import lru_cache
+from typing import Dict, Any, List, Optional, AsyncIterator
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+import openai
+from openai import AsyncOpenAI
 from dotenv import load_dotenv
-from document_parser import advanced_parser
+from cache import llm_cache
+from database import supabase_client
+from document_parser import _is_transient as _is_transient_http
 
-load_dotenv()
+# Static prompt text is kept at the front of every request so OpenAI's prompt cache can reuse the prefix
+SUMMARY_SYSTEM = "You are a medical AI assistant that analyzes medical reports and provides structured summaries."
 
-class LLMService:
-    def __init__(self):
-        self.client = OpenAI(api_key=os.getenv("LLM_API_KEY"))
-    
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-    async def summarize_report(self, text: str) -> Dict[str, Any]:
-        """Summarize medical report and extract key findings"""
-        prompt = f"""SYSTEM: You are a precise medical assistant. Output only JSON inside triple backticks labeled json, with fields:
+SUMMARY_INSTRUCTIONS = """You are a precise medical assistant. Output only a JSON object with fields:
 
-{{
+{
   "patient_name": "",
   "age": "",
   "gender": "",
-  "lab_results": {{ "Test Name": "value units", ...}},
-  "summary_text": ""  // 2-4 sentence explanation in layman terms, one or two action items
-}}
+  "lab_results": { "Test Name": "value units", ...},
+  "summary_text": "",  // 2-4 sentence explanation in layman terms, one or two action items
+  "urgency": "low|medium|high"  // required, never null
+}
+
+Notes: If any other field is missing, set it to null. Keep tone empathetic.
+
+Here is the report content: """
+
+CHUNK_INSTRUCTIONS = """You are a precise medical assistant. The text below is one section of a longer medical report. Write concise plain-text notes on it, keeping patient details, every lab result with its value and units, diagnoses, medications and recommendations. Do not add anything that is not in the section.
+
+Report section: """
+
+TRIAGE_SYSTEM = "You are a medical AI assistant that provides preliminary symptom analysis. Always emphasize the importance of professional medical consultation."
+
+TRIAGE_INSTRUCTIONS = """You are a triage assistant (informational only). Output only a JSON object:
+{
+  "possible_conditions": ["..."],
+  "urgency": "low|medium|high",
+  "recommended_actions": ["short layman-friendly steps"]
+}
+Use conservative judgment: when in doubt, mark urgency = high.
 
-USER: Here is the report content: {text}
+Patient reports: """
 
-Notes: If a specific field is missing, set it to null. Keep tone empathetic. At the end also output a plain-language one-line urgency tag (low/medium/high) outside the JSON."""
+# Inputs above these sizes are rejected before any OpenAI call is made
+MAX_REPORT_TOKENS = 200_000  # About 100 map calls
+MAX_MESSAGE_TOKENS = 4_000
+
+# Cheap pre-check before tokenizing. Real text averages about 4 bytes per token, so this
+# bound only rejects input that could never fit the token budget; the token count decides the rest
+MAX_BYTES_PER_TOKEN = 16
+
+class PromptTooLargeError(ValueError):
+    """Raised when user input exceeds the token budget for an LLM call"""
+
+@lru_cache(maxsize=1)
+def _encoding() -> tiktoken.Encoding:
+    return tiktoken.encoding_for_model("gpt-4o-mini")
+
+def load_tokenizer() -> None:
+    """Load the tiktoken encoding, which downloads its BPE file on first use; call off the event loop"""
+    _encoding()
+
+def _encode(text: str) -> List[int]:
+    return _encoding().encode(text)
+
+def _check_length(text: str, max_tokens: int, label: str) -> None:
+    size = len(text.encode("utf-8"))
+    if size > max_tokens * MAX_BYTES_PER_TOKEN:
+        raise PromptTooLargeError(f"{label} is too long ({size} bytes, limit {max_tokens * MAX_BYTES_PER_TOKEN})")
+
+def _split_tokens(text: str, tokens: List[int], max_tokens: int) -> List[str]:
+    if len(tokens) <= max_tokens:
+        return [text]
+    return [_encoding().decode(tokens[i:i + max_tokens]) for i in range(0, len(tokens), max_tokens)]
+
+def chunk_text(text: str, max_tokens: int = 2000) -> List[str]:
+    """Split text into pieces of at most max_tokens tokens"""
+    return _split_tokens(text, _encode(text), max_tokens)
+
+def _log_prompt_cache(response) -> None:
+    """Report how much of the prompt was served from OpenAI's prompt cache"""
+    usage = getattr(response, "usage", None)
+    # SDKs that predate the field keep it as a raw dict among the model's extra fields
+    details = getattr(usage, "prompt_tokens_details", None)
+    if isinstance(details, dict):
+        cached_tokens = details.get("cached_tokens")
+    else:
+        cached_tokens = getattr(details, "cached_tokens", None)
+    if usage is not None and cached_tokens is not None:
+        print(f"OpenAI prompt tokens: {usage.prompt_tokens} ({cached_tokens} cached)")
+
+def _is_transient(exc: BaseException) -> bool:
+    """Extend the httpx retry predicate with OpenAI rate limits, timeouts, dropped connections and 5xx errors"""
+    if isinstance(exc, (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)):
+        return True
+    return _is_transient_http(exc)
+
+class LLMService:
+    def __init__(self, model: str = "gpt-4o-mini"):
+        self.model = model
+        
+        # Pooled HTTP client shared by all OpenAI requests
+        self._http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100),
+            timeout=httpx.Timeout(60.0),
+            http2=True
+        )
+        # Retries are handled by the tenacity decorators, so disable the SDK's own to avoid stacking them
+        self.client = AsyncOpenAI(api_key=os.getenv("LLM_API_KEY"), http_client=self._http_client, max_retries=0)
+        
+        # Section notes (map) and the final structured summary (reduce) can use different models;
+        # short reports skip the map step and go straight to the reduce model
+        self.map_model = os.getenv("LLM_MAP_MODEL", model)
+        self.reduce_model = os.getenv("LLM_REDUCE_MODEL", model)
+        
+        # Cap concurrent chunk summaries for a single long report
+        self._chunk_sem = asyncio.Semaphore(int(os.getenv("LLM_MAX_CONC", "4")))
+    
+    async def aclose(self):
+        """Close the pooled HTTP client"""
+        await self._http_client.aclose()
+    
+    async def summarize_report(self, text: str) -> Dict[str, Any]:
+        """Summarize medical report and extract key findings"""
+        _check_length(text, MAX_REPORT_TOKENS, "Report")
+        cache_key = self._summary_cache_key(text)
+        cached = await llm_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
+        # Chunk summaries retry on their own, so only the reduce call is retried below
+        prompt = SUMMARY_INSTRUCTIONS + await self._reduce_input(text)
+        response = await self._create_summary(prompt)
+        _log_prompt_cache(response)
+        
+        parsed_data = self._finish_summary(response.choices[0].message.content)
+        
+        await llm_cache.set(cache_key, self.reduce_model, parsed_data)
+        return parsed_data
+    
+    async def stream_summary(self, text: str) -> AsyncIterator[str]:
+        """
+        Summarize a medical report, yielding the summary JSON text as it is generated.
         
-        response = self.client.chat.completions.create(
-            model="gpt-4",
+        A cached summary is yielded in one piece. The completed summary is parsed
+        and cached exactly like summarize_report, so the two share cache entries;
+        if it is not valid JSON, the generator raises after the last piece.
+        """
+        _check_length(text, MAX_REPORT_TOKENS, "Report")
+        cache_key = self._summary_cache_key(text)
+        cached = await llm_cache.get(cache_key)
+        if cached is not None:
+            yield orjson.dumps(cached).decode()
+            return
+        
+        prompt = SUMMARY_INSTRUCTIONS + await self._reduce_input(text)
+        stream = await self._open_summary_stream(prompt)
+        
+        parts = []
+        async for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                parts.append(delta)
+                yield delta
+        
+        # Raises if the streamed text is not valid JSON, so the caller can report it
+        await llm_cache.set(cache_key, self.reduce_model, self._finish_summary("".join(parts)))
+    
+    @retry(stop=stop_after_attempt(3), wait=wait_random_exponential(min=1, max=10), retry=retry_if_exception(_is_transient))
+    async def _create_summary(self, prompt: str):
+        """Run the reduce completion for summarize_report"""
+        return await self.client.chat.completions.create(
+            model=self.reduce_model,
             messages=[
-                {"role": "system", "content": "You are a medical AI assistant that analyzes medical reports and provides structured summaries."},
+                {"role": "system", "content": SUMMARY_SYSTEM},
                 {"role": "user", "content": prompt}
             ],
+            response_format={"type": "json_object"},
             temperature=0.1
         )
+    
+    @retry(stop=stop_after_attempt(3), wait=wait_random_exponential(min=1, max=10), retry=retry_if_exception(_is_transient))
+    async def _open_summary_stream(self, prompt: str):
+        """Start the streaming summary call; retried here because the SDK's own retries are disabled"""
+        return await self.client.chat.completions.create(
+            model=self.reduce_model,
+            messages=[
+                {"role": "system", "content": SUMMARY_SYSTEM},
+                {"role": "user", "content": prompt}
+            ],
+            response_format={"type": "json_object"},
+            temperature=0.1,
+            stream=True
+        )
+    
+    def _summary_cache_key(self, text: str) -> str:
+        return llm_cache.make_key(f"{self.map_model}>{self.reduce_model}", text, SUMMARY_INSTRUCTIONS)
+    
+    async def _reduce_input(self, text: str) -> str:
+        """Return the text for the final summary call, condensing long reports first"""
+        # Tokenize off the event loop; callers have already applied the cheap length check
+        tokens = await asyncio.to_thread(_encode, text)
+        if len(tokens) > MAX_REPORT_TOKENS:
+            raise PromptTooLargeError(f"Report is too long to summarize ({len(tokens)} tokens, limit {MAX_REPORT_TOKENS})")
         
-        # Parse response that contains JSON in triple backticks plus urgency tag
-        content = response.choices[0].message.content
-        
-        # Extract JSON from triple backticks
-        import re
-        json_match = re.search(r'```json\s*(.*?)\s*```', content, re.DOTALL)
-        if json_match:
-            json_str = json_match.group(1)
-            parsed_data = json.loads(json_str)
-        else:
-            # Fallback: try to parse entire content as JSON
-            parsed_data = json.loads(content)
-        
-        # Extract urgency tag (outside JSON)
-        urgency_match = re.search(r'(?:urgency|priority):\s*(low|medium|high)', content.lower())
-        if urgency_match:
-            parsed_data["urgency"] = urgency_match.group(1)
-        else:
-            # Look for standalone urgency words
-            urgency_match = re.search(r'\b(low|medium|high)\s*(?:urgency|priority)?\b', content.lower())
-            if urgency_match:
-                parsed_data["urgency"] = urgency_match.group(1)
-            else:
-                parsed_data["urgency"] = "medium"  # Default fallback
+        # Long reports are summarized section by section in parallel, then the notes are reduced
+        chunks = await asyncio.to_thread(_split_tokens, text, tokens, 2000)
+        if len(chunks) > 1:
+            partials = await asyncio.gather(*[self._summarize_chunk(chunk) for chunk in chunks])
+            text = "\n\n".join(partials)
+        return text
+    
+    @staticmethod
+    def _finish_summary(content: str) -> Dict[str, Any]:
+        """Parse the summary JSON, defaulting the urgency when the model left it out"""
+        parsed_data = orjson.loads(content)
+        
+        if not parsed_data.get("urgency"):
+            parsed_data["urgency"] = "medium"  # Default fallback
         
         return parsed_data
     
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
+    @retry(stop=stop_after_attempt(3), wait=wait_random_exponential(min=1, max=10), retry=retry_if_exception(_is_transient))
+    async def _summarize_chunk(self, chunk: str) -> str:
+        """Condense one section of a long report into plain-text notes"""
+        cache_key = llm_cache.make_key(self.map_model, chunk, CHUNK_INSTRUCTIONS)
+        cached = await llm_cache.get(cache_key)
+        if cached is not None:
+            return cached["notes"]
+        
+        prompt = CHUNK_INSTRUCTIONS + chunk
+        
+        async with self._chunk_sem:
+            response = await self.client.chat.completions.create(
+                model=self.map_model,
+                messages=[
+                    {"role": "system", "content": SUMMARY_SYSTEM},
+                    {"role": "user", "content": prompt}
+                ],
+                temperature=0.1
+            )
+        _log_prompt_cache(response)
+        
+        notes = response.choices[0].message.content
+        await llm_cache.set(cache_key, self.map_model, {"notes": notes})
+        return notes
+    
+    @retry(stop=stop_after_attempt(3), wait=wait_random_exponential(min=1, max=10), retry=retry_if_exception(_is_transient))
     async def analyze_symptoms(self, message: str, user_history: Optional[str] = None) -> Dict[str, Any]:
         """Analyze symptoms and provide medical guidance"""
         context = f"\nUser's medical history context: {user_history}" if user_history else ""
         
-        prompt = f"""SYSTEM: You are a triage assistant (informational only). Output JSON only inside triple backticks labeled json:
-{{
-  "possible_conditions": ["..."],
-  "urgency": "low|medium|high",
-  "recommended_actions": "short layman-friendly steps"
-}}
-USER: Patient reports: "{message}". Use conservative judgment: when in doubt, mark urgency = high."""
+        _check_length(message, MAX_MESSAGE_TOKENS, "Message")
+        message_tokens = len(await asyncio.to_thread(_encode, message))
+        if message_tokens > MAX_MESSAGE_TOKENS:
+            raise PromptTooLargeError(f"Message is too long to analyze ({message_tokens} tokens, limit {MAX_MESSAGE_TOKENS})")
+        
+        cache_key = llm_cache.make_key(self.model, message.lower(), TRIAGE_INSTRUCTIONS)
+        cached = await llm_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
+        analysis = await self._triage_one(message)
         
-        response = self.client.chat.completions.create(
-            model="gpt-4",
+        await llm_cache.set(cache_key, self.model, analysis)
+        return analysis
+    
+    async def _triage_one(self, message: str) -> Dict[str, Any]:
+        """Analyze a single patient message"""
+        response = await self.client.chat.completions.create(
+            model=self.model,
             messages=[
-                {"role": "system", "content": "You are a medical AI assistant that provides preliminary symptom analysis. Always emphasize the importance of professional medical consultation."},
-                {"role": "user", "content": prompt}
+                {"role": "system", "content": TRIAGE_SYSTEM},
+                {"role": "user", "content": f'{TRIAGE_INSTRUCTIONS}"{message}"'}
             ],
+            response_format={"type": "json_object"},
             temperature=0.3
         )
+        _log_prompt_cache(response)
         
-        # Parse response that contains JSON in triple backticks
-        content = response.choices[0].message.content
-        
-        # Extract JSON from triple backticks
-        import re
-        json_match = re.search(r'```json\s*(.*?)\s*```', content, re.DOTALL)
-        if json_match:
-            json_str = json_match.group(1)
-            return json.loads(json_str)
-        else:
-            # Fallback: try to parse entire content as JSON
-            return json.loads(content)
+        return orjson.loads(response.choices[0].message.content)
 
-class PDFParserService:
-    @staticmethod
-    async def parse_pdf(file_content: bytes, filename: str = "document.pdf", file_url: Optional[str] = None) -> str:
-        """
-        Advanced PDF parsing using LlamaParse/Unstructured APIs with OCR fallback
+class ElevenLabsService:
+    def __init__(self):
+        self.api_key = os.getenv("ELEVENLABS_KEY")
+        self.base_url = "https://api.elevenlabs.io/v1"
         
-        Args:
-            file_content: Raw file bytes
-            filename: Original filename for API calls
-            file_url: Optional signed URL for the file (used by Unstructured API)
+        # Shared connection pool so repeated TTS calls reuse keep-alive TLS sessions to one host
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            http2=True,
+            timeout=httpx.Timeout(60.0, connect=10.0),
+            limits=httpx.Limits(max_keepalive_connections=16, max_connections=32),
+            headers={"xi-api-key": self.api_key or "", "Accept": "audio/mpeg"}
+        )
         
-        Returns:
-            Extracted and structured text content
-        """
+        # Cap in-flight synthesis calls to stay inside the ElevenLabs concurrency budget
+        self._sem = asyncio.Semaphore(int(os.getenv("ELEVENLABS_MAX_CONC", "4")))
+        
+        self.model_id = "eleven_monolingual_v1"
+        self.voice_settings = {
+            "stability": 0.5,
+            "similarity_boost": 0.5
+        }
+        
+        # Background uploads of freshly generated audio to the tts-cache bucket
+        self._pending_uploads = set()
+        
+        # Local LRU tier in front of the bucket, so repeated phrases skip the network entirely
+        self._disk_cache = diskcache.Cache(
+            os.getenv("TTS_CACHE_DIR", "/tmp/tts_cache"),
+            size_limit=int(os.getenv("TTS_CACHE_SIZE_LIMIT", str(2**30))),
+            eviction_policy="least-recently-used"
+        )
+    
+    async def aclose(self):
+        """Close the pooled HTTP client and the local audio cache"""
+        await self._client.aclose()
+        self._disk_cache.close()
+    
+    def cache_key(self, text: str, voice_id: str = "21m00Tcm4TlvDq8ikWAM") -> str:
+        """Hash everything that affects the generated audio"""
+        settings = f"{self.voice_settings['stability']}|{self.voice_settings['similarity_boost']}"
+        return hashlib.sha256(f"{voice_id}|{self.model_id}|{settings}|{text}".encode("utf-8")).hexdigest()
+    
+    async def get_local_audio(self, text: str, voice_id: str = "21m00Tcm4TlvDq8ikWAM") -> Optional[bytes]:
+        """Return previously generated audio from the local disk cache, or None if it is not there"""
         try:
-            # Use advanced document parser with multiple parsing strategies
-            return await advanced_parser.parse_document(file_content, filename, file_url)
-        except Exception as e:
-            # Final fallback to basic PyPDF2 extraction
-            try:
-                pdf_file = BytesIO(file_content)
-                pdf_reader = PyPDF2.PdfReader(pdf_file)
-                
-                text = ""
-                for page in pdf_reader.pages:
-                    text += page.extract_text() + "\n"
-                
-                return text.strip() if text.strip() else "No text could be extracted from this document."
-            except Exception as fallback_error:
-                raise ValueError(f"All parsing methods failed. Advanced parser: {str(e)}, Basic parser: {str(fallback_error)}")
+            return await asyncio.to_thread(self._disk_cache.get, self.cache_key(text, voice_id))
+        except Exception:
+            return None
     
-    @staticmethod
-    def parse_pdf_sync(file_content: bytes) -> str:
-        """Synchronous fallback method for compatibility"""
+    async def get_cached_url(self, text: str, voice_id: str = "21m00Tcm4TlvDq8ikWAM", expires_in: int = 3600) -> Optional[str]:
+        """Return a signed URL for previously generated audio, or None if it is not cached"""
         try:
-            pdf_file = BytesIO(file_content)
-            pdf_reader = PyPDF2.PdfReader(pdf_file)
-            
-            text = ""
-            for page in pdf_reader.pages:
-                text += page.extract_text() + "\n"
-            
-            return text.strip()
-        except Exception as e:
-            raise ValueError(f"Failed to parse PDF: {str(e)}")
-
-class ElevenLabsService:
-    def __init__(self):
-        self.api_key = os.getenv("ELEVENLABS_KEY")
-        self.base_url = "https://api.elevenlabs.io/v1"
+            supabase = supabase_client.get_client()
+            response = await asyncio.to_thread(
+                supabase.storage.from_("tts-cache").create_signed_url, f"{self.cache_key(text, voice_id)}.mp3", expires_in
+            )
+            return response.get("signedURL")
+        except Exception:
+            return None
     
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-    async def text_to_speech(self, text: str, voice_id: str = "21m00Tcm4TlvDq8ikWAM") -> bytes:
-        """Convert text to speech using ElevenLabs API"""
-        url = f"{self.base_url}/text-to-speech/{voice_id}"
+    async def stream_tts(self, text: str, voice_id: str = "21m00Tcm4TlvDq8ikWAM") -> AsyncIterator[bytes]:
+        """
+        Convert text to speech using ElevenLabs API, yielding audio as it is generated.
         
-        headers = {
-            "Accept": "audio/mpeg",
-            "Content-Type": "application/json",
-            "xi-api-key": self.api_key
-        }
+        The concurrency slot and upstream response are only taken once iteration starts,
+        and this generator always releases them, so a response that is abandoned before
+        or during streaming cannot leak them. Completed audio is saved to the local disk
+        cache and the tts-cache bucket in the background.
+        """
+        chunks = []
+        async with self._sem:
+            response = await self._open_tts_stream(text, voice_id)
+            try:
+                async for chunk in response.aiter_bytes():
+                    chunks.append(chunk)
+                    yield chunk
+            finally:
+                await response.aclose()
         
+        # Only reached when the whole stream was delivered
+        task = asyncio.create_task(self._store_audio(self.cache_key(text, voice_id), b"".join(chunks)))
+        self._pending_uploads.add(task)
+        task.add_done_callback(self._pending_uploads.discard)
+    
+    @retry(stop=stop_after_attempt(3), wait=wait_random_exponential(min=1, max=10), retry=retry_if_exception(_is_transient))
+    async def _open_tts_stream(self, text: str, voice_id: str) -> httpx.Response:
         data = {
             "text": text,
-            "model_id": "eleven_monolingual_v1",
-            "voice_settings": {
-                "stability": 0.5,
-                "similarity_boost": 0.5
-            }
+            "model_id": self.model_id,
+            "voice_settings": self.voice_settings
         }
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, json=data, headers=headers)
+        request = self._client.build_request(
+            "POST",
+            f"/text-to-speech/{voice_id}",
+            content=orjson.dumps(data),
+            headers={"Content-Type": "application/json"}
+        )
+        response = await self._client.send(request, stream=True)
+        if response.is_error:
+            await response.aclose()
             response.raise_for_status()
-            return response.content
+        return response
+    
+    async def _store_audio(self, cache_key: str, audio: bytes) -> None:
+        try:
+            await asyncio.to_thread(self._disk_cache.set, cache_key, audio)
+        except Exception as e:
+            print(f"TTS disk cache write failed: {e}")
+        
+        try:
+            supabase = supabase_client.get_client()
+            await asyncio.to_thread(
+                supabase.storage.from_("tts-cache").upload,
+                path=f"{cache_key}.mp3",
+                file=audio,
+                file_options={"content-type": "audio/mpeg"}
+            )
+        except Exception as e:
+            print(f"TTS cache upload failed: {e}")
+
+# Services are built on first use, so importing this module does no setup work
+@lru_cache(maxsize=1)
+def get_llm_service() -> LLMService:
+    load_dotenv()
+    return LLMService()
 
-# Service instances
-llm_service = LLMService()
-pdf_parser = PDFParserService()
-tts_service = ElevenLabsService()
+@lru_cache(maxsize=1)
+def get_tts_service() -> ElevenLabsService:
+    load_dotenv()
+    return ElevenLabsService()
@@ -0,0 +1,10 @@
+import os
+import sys
+
+# Tests import the app modules from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Mock credentials keep module-level clients from reaching real services
+os.environ.setdefault("SUPABASE_URL", "https://mock-project.supabase.co")
+os.environ.setdefault("SUPABASE_KEY", "mock_key")
+os.environ.setdefault("LLM_API_KEY", "mock_key")
@@ -0,0 +1,40 @@
+from io import BufferedReader
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+from fastapi.testclient import TestClient
+
+import main
+
+
+def test_upload_report_streams_file_to_storage(monkeypatch):
+    uploaded = {}
+
+    def upload(path, file, file_options):
+        # storage3 < 0.7 only sends bytes, BufferedReader or FileIO as-is
+        assert isinstance(file, BufferedReader)
+        uploaded["path"] = path
+        uploaded["content"] = file.read()
+        return SimpleNamespace(error=None)
+
+    supabase = MagicMock()
+    supabase.storage.from_.return_value.upload.side_effect = upload
+    supabase.table.return_value.insert.return_value.execute.return_value = SimpleNamespace(
+        data=[{"id": "doc-1"}], error=None
+    )
+    monkeypatch.setattr(main.supabase_client, "get_client", lambda: supabase)
+
+    client = TestClient(main.app)
+    response = client.post(
+        "/upload-report",
+        data={"user_id": "user-1"},
+        files={"file": ("report.pdf", b"%PDF-1.4 test", "application/pdf")},
+    )
+
+    assert response.status_code == 200
+    supabase.storage.from_.assert_called_with("reports")
+    assert uploaded["content"] == b"%PDF-1.4 test"
+    assert uploaded["path"].startswith("user-1/")
+
+    document = supabase.table.return_value.insert.call_args.args[0]
+    assert document["file_size"] == len(b"%PDF-1.4 test")